@@ -1,8 +1,14 @@
-from mcp.server.fastmcp import FastMCP
+from mcp.server.fastmcp import FastMCP, Context
 import subprocess
 import json
 import re
-from typing import Dict, Any, List, Union
+import heapq
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple, Union
 
 # Configure the server
 mcp = FastMCP(
@@ -16,6 +22,40 @@ mcp = FastMCP(
 OPENSEARCH_URL = "http://localhost:9200"
 OPENSEARCH_PASSWORD = "MyPassword123!"
 
+# Slow-query recorder settings
+SLOW_QUERY_LOG_SIZE = 20  # number of slowest queries kept in memory
+
+# Slow-query log: min-heap of (latency_ms, seq, entry) so the fastest of the
+# N slowest queries is always at the top and is the one evicted.
+SLOW_QUERIES: List[Tuple[float, int, Dict[str, Any]]] = []
+SLOW_QUERY_LOCK = threading.Lock()
+SLOW_QUERY_SEQ = itertools.count()
+
+# Next-page prefetch settings for opensearch_search_index(prefetch=True)
+PREFETCH_MAX_PER_SESSION = 2  # outstanding prefetched pages per client session
+PREFETCH_BUFFER_SIZE = 16  # prefetched pages held across all sessions
+PREFETCH_TTL_SECONDS = 10  # unclaimed prefetches are dropped after this long
+MAX_RESULT_WINDOW = 10000  # OpenSearch index.max_result_window default
+
+# Prefetch buffer: (session, index_name, query key) -> {"future", "expires"}, oldest first
+PREFETCH_BUFFER: "OrderedDict[Tuple[int, str, str], Dict[str, Any]]" = OrderedDict()
+PREFETCH_LOCK = threading.Lock()
+PREFETCH_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="prefetch")
+
+# Field types per index, flattened from the mapping: index_name -> (fetched_at, {field: type})
+MAPPING_CACHE_TTL_SECONDS = 300
+MAPPING_CACHE: Dict[str, Tuple[float, Dict[str, str]]] = {}
+
+# date_histogram intervals: single calendar units go in calendar_interval, multiples of ms/s/m/h/d in fixed_interval
+CALENDAR_INTERVALS = {"1m", "minute", "1h", "hour", "1d", "day", "1w", "week", "1M", "month", "1q", "quarter", "1y", "year"}
+FIXED_INTERVAL_PATTERN = re.compile(r'^\d+(ms|s|m|h|d)$')
+
+# Continuous numeric types, where a terms facet would return one bucket per distinct value
+CONTINUOUS_TYPES = {"float", "double", "half_float", "scaled_float"}
+
+# Top-level keys that mark query_dsl as a full search body rather than a query clause
+SEARCH_BODY_KEYS = {"query", "size", "from", "sort", "_source", "aggs", "aggregations", "track_total_hits", "search_after", "search_pipeline", "highlight", "post_filter", "min_score", "timeout"}
+
 # Define search templates
 TEMPLATES = [
     
@@ -105,27 +145,55 @@ def opensearch_get_index_mapping(index_name: str) -> dict:
     
     if response.returncode == 0:
         try:
-            return json.loads(response.stdout)
+            result = json.loads(response.stdout)
         except json.JSONDecodeError:
             return {"error": "Failed to parse JSON response", "raw_response": response.stdout}
+        if "error" not in result:
+            cache_field_types(index_name, result)
+        return result
     else:
         return {"error": f"Request failed: {response.stderr}", "returncode": response.returncode}
 
 
 @mcp.tool()
-def opensearch_search_index(index_name: str, query_dsl: Any) -> dict:
-    """Searches an index using a query written in query domain-specific language (DSL) in OpenSearch."""
-    # Convert query to JSON string
-    query_json = json.dumps(query_dsl)
+def opensearch_search_index(index_name: str, query_dsl: Any, prefetch: bool = False, ctx: Context = None) -> dict:
+    """Searches an index using a query written in query domain-specific language (DSL) in OpenSearch.
+    Set `prefetch` to true when reading results page by page (`from`/`size` or `search_after`):
+    the next page is fetched in the background so the follow-up request returns without a round trip."""
+    session = id(ctx.session) if ctx is not None else 0
+    start = time.perf_counter()
+    claimed = claim_prefetch(session, index_name, query_dsl)
+    if claimed is not None:
+        print(f"Serving prefetched page for index {index_name}")
+        response, result = claimed
+        # Record what the caller waited for, including any wait on a prefetch still in flight
+        wait_ms = round((time.perf_counter() - start) * 1000, 3)
+        record_slow_query({
+            "source": "opensearch_search_index",
+            "index_name": index_name,
+            "template_name": None,
+            "query": query_dsl,
+            "latency_ms": wait_ms,
+            "phases": {
+                "prefetch_wait_ms": wait_ms,
+                "opensearch_took_ms": result.get("took")
+            },
+            "status": "ok",
+            "prefetched": True,
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+        })
+    else:
+        response, result = run_search(index_name, query_dsl, "opensearch_search_index")
     
-    curl_command = f"curl -X POST '{OPENSEARCH_URL}/{index_name}/_search' -H 'Content-Type: application/json' -d '{query_json}' -u admin:{OPENSEARCH_PASSWORD} --insecure"
-    response = subprocess.run(curl_command, shell=True, capture_output=True, text=True)
+    if prefetch and result is not None and "error" not in result:
+        next_query = next_page_query(query_dsl, result)
+        if next_query is not None:
+            schedule_prefetch(session, index_name, next_query)
     
     if response.returncode == 0:
-        try:
-            return json.loads(response.stdout)
-        except json.JSONDecodeError:
-            return {"error": "Failed to parse JSON response", "raw_response": response.stdout}
+        if result is not None:
+            return result
+        return {"error": "Failed to parse JSON response", "raw_response": response.stdout}
     else:
         return {"error": f"Request failed: {response.stderr}", "returncode": response.returncode}
 
@@ -152,21 +220,9 @@ Returns search results, template metadata, or error details.
     # Only parse placeholders for operations that need them
     placeholders = None
     if operation == "executeTemplate":
-        if not placeholders_json:
-            return {"error": "placeholders_json is required for executeTemplate operation"}
-        
-        # Handle both string and dict inputs
-        if isinstance(placeholders_json, str):
-            if placeholders_json.strip() == "":
-                return {"error": "placeholders_json cannot be empty for executeTemplate operation"}
-            try:
-                placeholders = json.loads(placeholders_json)
-            except json.JSONDecodeError as e:
-                return {"error": f"Invalid JSON in placeholders_json: {str(e)}"}
-        elif isinstance(placeholders_json, dict):
-            placeholders = placeholders_json
-        else:
-            return {"error": f"placeholders_json must be a string or dict, got {type(placeholders_json)}"}
+        placeholders, error = parse_placeholders(placeholders_json)
+        if error:
+            return error
 
     if operation == "listTemplates":
         # Return list of templates with metadata
@@ -219,59 +275,93 @@ Returns search results, template metadata, or error details.
         if not placeholders:
             return {"error": "placeholders are required for executeTemplate operation"}
         
-        # Find the template
-        template_data = None
-        for template in TEMPLATES:
-            if template["name"] == template_name:
-                template_data = template
-                break
-        
-        if not template_data:
-            return {"error": f"Template '{template_name}' not found"}
-        
-        # Validate required parameters
-        missing_params = []
-        for param_name, param_info in template_data["parameters"].items():
-            if param_info.get("required", False) and param_name not in placeholders:
-                print(f"Missing required parameter: {param_name}")
-                missing_params.append(param_name)
-        
-        if missing_params:
-            return {"error": f"Missing required parameters: {', '.join(missing_params)}"}
-        
-        # Process the template
-        template_str = template_data["template"]
-        
-        # Process placeholders
-        processed_template = process_template(template_str, placeholders)
-        
-        # Parse the processed template as JSON
-        try:
-            query_dsl = json.loads(processed_template)
-        except json.JSONDecodeError as e:
-            return {
-                "error": f"Failed to parse template as JSON: {str(e)}",
-                "processed_template": processed_template
-            }
-        
-        # Get the index name from placeholders or default
-        index_name = template_data["index_name"]
-        if not index_name:
-            # Check if there's a default index in the template parameters
-            for param_name, param_info in template_data["parameters"].items():
-                if param_name == "index_name" and "default" in param_info:
-                    index_name = param_info["default"]
-                    break
-        
-        if not index_name:
-            return {"error": "index_name is required but not provided in placeholders or template defaults"}
+        rendered = render_template(template_name, placeholders)
+        if "error" in rendered:
+            return rendered
         
         # Execute the search
-        return execute_search(index_name, query_dsl, template_name)
+        return execute_search(rendered["index_name"], rendered["query"], template_name, rendered["render_ms"])
     
     else:
         return {"error": f"Invalid operation: {operation}. Valid operations are: listTemplates, getTemplate, executeTemplate"}
 
+def parse_placeholders(placeholders_json: Union[str, Dict[str, Any], None], operation: str = "executeTemplate operation") -> Tuple[Optional[Dict[str, Any]], Optional[Dict[str, Any]]]:
+    """Parse placeholders given as a JSON string or dict. Returns (placeholders, error); errors name the calling operation."""
+    if not placeholders_json:
+        return None, {"error": f"placeholders_json is required for {operation}"}
+    
+    # Handle both string and dict inputs
+    if isinstance(placeholders_json, str):
+        if placeholders_json.strip() == "":
+            return None, {"error": f"placeholders_json cannot be empty for {operation}"}
+        try:
+            return json.loads(placeholders_json), None
+        except json.JSONDecodeError as e:
+            return None, {"error": f"Invalid JSON in placeholders_json: {str(e)}"}
+    elif isinstance(placeholders_json, dict):
+        return placeholders_json, None
+    else:
+        return None, {"error": f"placeholders_json must be a string or dict, got {type(placeholders_json)}"}
+
+
+def render_template(template_name: str, placeholders: Dict[str, Any]) -> Dict[str, Any]:
+    """Render a template into query DSL. Returns index_name, query and render_ms, or error details."""
+    start = time.perf_counter()
+    
+    # Find the template
+    template_data = None
+    for template in TEMPLATES:
+        if template["name"] == template_name:
+            template_data = template
+            break
+    
+    if not template_data:
+        return {"error": f"Template '{template_name}' not found"}
+    
+    # Validate required parameters
+    missing_params = []
+    for param_name, param_info in template_data["parameters"].items():
+        if param_info.get("required", False) and param_name not in placeholders:
+            print(f"Missing required parameter: {param_name}")
+            missing_params.append(param_name)
+    
+    if missing_params:
+        return {"error": f"Missing required parameters: {', '.join(missing_params)}"}
+    
+    # Process the template
+    template_str = template_data["template"]
+    
+    # Process placeholders
+    processed_template = process_template(template_str, placeholders)
+    
+    # Parse the processed template as JSON
+    try:
+        query_dsl = json.loads(processed_template)
+    except json.JSONDecodeError as e:
+        return {
+            "error": f"Failed to parse template as JSON: {str(e)}",
+            "processed_template": processed_template
+        }
+    
+    # Get the index name from placeholders or default
+    index_name = template_data["index_name"]
+    if not index_name:
+        # Check if there's a default index in the template parameters
+        for param_name, param_info in template_data["parameters"].items():
+            if param_name == "index_name" and "default" in param_info:
+                index_name = param_info["default"]
+                break
+    
+    if not index_name:
+        return {"error": "index_name is required but not provided in placeholders or template defaults"}
+    
+    return {
+        "index_name": index_name,
+        "query": query_dsl,
+        "render_ms": round((time.perf_counter() - start) * 1000, 3)
+    }
+
+
 def process_template(template_str: str, placeholders: Dict[str, Any]) -> str:
     """Process a template string by replacing placeholders and handling conditional blocks"""
     print(f"Processing template: {template_str}")
@@ -325,27 +415,512 @@ def process_template(template_str: str, placeholders: Dict[str, Any]) -> str:
     return template_str
 
 
-def execute_search(index_name: str, query_dsl: Dict[str, Any], template_name: str) -> Dict[str, Any]:
+def execute_search(index_name: str, query_dsl: Dict[str, Any], template_name: str, render_ms: float = 0.0) -> Dict[str, Any]:
     """Execute a search against OpenSearch"""
     print(f"Executing search for index {index_name} with query {query_dsl}")
-    curl_command = f"curl -X POST '{OPENSEARCH_URL}/{index_name}/_search' -H 'Content-Type: application/json' -d '{json.dumps(query_dsl)}' -u admin:{OPENSEARCH_PASSWORD} --insecure"
-    response = subprocess.run(curl_command, shell=True, capture_output=True, text=True)
+    response, result = run_search(index_name, query_dsl, "templated_search", template_name, render_ms)
     
     if response.returncode == 0:
-        try:
-            result = json.loads(response.stdout)
+        if result is not None:
             return {
                 "template_name": template_name,
                 "index_name": index_name,
                 "query": query_dsl,
                 "result": result
             }
-        except json.JSONDecodeError:
-            return {"error": "Failed to parse search results", "raw_response": response.stdout}
+        return {"error": "Failed to parse search results", "raw_response": response.stdout}
     else:
         return {"error": f"Search request failed: {response.stderr}", "query": query_dsl}
 
 
+def run_search(index_name: str, query_dsl: Any, source: str, template_name: str = None, render_ms: float = 0.0) -> Tuple[subprocess.CompletedProcess, Optional[Dict[str, Any]]]:
+    """POST a query to the _search endpoint and record its latency in the slow-query log.
+    Returns the curl response and the parsed JSON body (None if it could not be parsed)."""
+    curl_command = f"curl -X POST '{OPENSEARCH_URL}/{index_name}/_search' -H 'Content-Type: application/json' -d '{json.dumps(query_dsl)}' -u admin:{OPENSEARCH_PASSWORD} --insecure"
+    start = time.perf_counter()
+    response = subprocess.run(curl_command, shell=True, capture_output=True, text=True)
+    request_ms = (time.perf_counter() - start) * 1000
+    
+    result = None
+    if response.returncode == 0:
+        try:
+            result = json.loads(response.stdout)
+        except json.JSONDecodeError:
+            pass
+    parse_ms = (time.perf_counter() - start) * 1000 - request_ms
+    
+    # Background prefetches are not end-to-end latencies; opensearch_search_index records the wait when one is claimed
+    if source == "prefetch":
+        return response, result
+    
+    took_ms = result.get("took") if isinstance(result, dict) else None
+    record_slow_query({
+        "source": source,
+        "index_name": index_name,
+        "template_name": template_name,
+        "query": query_dsl,
+        "latency_ms": round(render_ms + request_ms + parse_ms, 3),
+        "phases": {
+            "render_ms": round(render_ms, 3),
+            "request_ms": round(request_ms, 3),
+            "opensearch_took_ms": took_ms,
+            "parse_ms": round(parse_ms, 3)
+        },
+        "status": "ok" if result is not None and "error" not in result else "error",
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    })
+    return response, result
+
+
+def paging_int(value: Any, default: int) -> Optional[int]:
+    """Read a from/size value the way OpenSearch does: null means the default and numeric strings are accepted"""
+    if value is None:
+        return default
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and value.strip().isdigit():
+        return int(value)
+    return None
+
+
+def next_page_query(query_dsl: Any, result: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Build the query for the page after result, or None if this was the last page.
+    A search_after query continues with the last hit's sort values, anything else with from + size."""
+    if not isinstance(query_dsl, dict):
+        return None
+    hits = result.get("hits", {}).get("hits", [])
+    size = paging_int(query_dsl.get("size"), 10)
+    if size is None or size <= 0 or len(hits) < size:
+        return None
+    
+    if "search_after" in query_dsl:
+        sort_values = hits[-1].get("sort")
+        if not sort_values:
+            return None
+        return dict(query_dsl, search_after=sort_values)
+    
+    from_ = paging_int(query_dsl.get("from"), 0)
+    if from_ is None:
+        return None
+    next_from = from_ + size
+    if next_from + size > MAX_RESULT_WINDOW:
+        return None
+    return dict(query_dsl, **{"from": next_from})
+
+
+def prefetch_key(session: int, index_name: str, query_dsl: Any) -> Tuple[int, str, str]:
+    return (session, index_name, json.dumps(query_dsl, sort_keys=True))
+
+
+def evict_expired_prefetches(now: float) -> None:
+    """Drop unclaimed prefetches past their TTL. Caller must hold PREFETCH_LOCK."""
+    for key in [key for key, entry in PREFETCH_BUFFER.items() if entry["expires"] <= now]:
+        PREFETCH_BUFFER.pop(key)["future"].cancel()
+
+
+def schedule_prefetch(session: int, index_name: str, query_dsl: Dict[str, Any]) -> None:
+    """Fetch query_dsl in the background unless the session has used up its prefetch budget"""
+    key = prefetch_key(session, index_name, query_dsl)
+    now = time.monotonic()
+    with PREFETCH_LOCK:
+        evict_expired_prefetches(now)
+        if key in PREFETCH_BUFFER:
+            return
+        if sum(1 for k in PREFETCH_BUFFER if k[0] == session) >= PREFETCH_MAX_PER_SESSION:
+            return
+        if len(PREFETCH_BUFFER) >= PREFETCH_BUFFER_SIZE:
+            _, oldest = PREFETCH_BUFFER.popitem(last=False)
+            oldest["future"].cancel()
+        future: Future = PREFETCH_EXECUTOR.submit(run_search, index_name, query_dsl, "prefetch")
+        PREFETCH_BUFFER[key] = {"future": future, "expires": now + PREFETCH_TTL_SECONDS}
+
+
+def claim_prefetch(session: int, index_name: str, query_dsl: Any) -> Optional[Tuple[subprocess.CompletedProcess, Optional[Dict[str, Any]]]]:
+    """Take a prefetched (response, result) for this query out of the buffer, waiting if it is still in flight"""
+    if not isinstance(query_dsl, dict):
+        return None
+    key = prefetch_key(session, index_name, query_dsl)
+    with PREFETCH_LOCK:
+        evict_expired_prefetches(time.monotonic())
+        entry = PREFETCH_BUFFER.pop(key, None)
+    if entry is None:
+        return None
+    try:
+        response, result = entry["future"].result()
+    except Exception as e:
+        print(f"Prefetch failed, running search directly: {e}")
+        return None
+    if response.returncode != 0 or result is None or "error" in result:
+        return None
+    return response, result
+
+
+def record_slow_query(entry: Dict[str, Any]) -> None:
+    """Keep entry if it is among the SLOW_QUERY_LOG_SIZE slowest queries seen so far"""
+    item = (entry["latency_ms"], next(SLOW_QUERY_SEQ), entry)
+    with SLOW_QUERY_LOCK:
+        if len(SLOW_QUERIES) < SLOW_QUERY_LOG_SIZE:
+            heapq.heappush(SLOW_QUERIES, item)
+        elif item[0] > SLOW_QUERIES[0][0]:
+            heapq.heapreplace(SLOW_QUERIES, item)
+
+
+def summarize_profile_query(node: Dict[str, Any], max_depth: int, depth: int = 0) -> Dict[str, Any]:
+    """Condense one node of a query profile tree into type, description, time and children"""
+    description = node.get("description", "")
+    summary = {
+        "type": node.get("type"),
+        "description": description if len(description) <= 120 else description[:117] + "...",
+        "time_ms": round(node.get("time_in_nanos", 0) / 1_000_000, 3)
+    }
+    breakdown = node.get("breakdown", {})
+    # Only keep the dominant timing components, the full breakdown has ~20 counters
+    phases = {
+        key: round(value / 1_000_000, 3)
+        for key, value in breakdown.items()
+        if not key.endswith("_count") and value > 0
+    }
+    if phases:
+        top = sorted(phases.items(), key=lambda kv: kv[1], reverse=True)[:3]
+        summary["top_phases_ms"] = dict(top)
+    children = node.get("children", [])
+    if children:
+        if depth + 1 < max_depth:
+            summary["children"] = [summarize_profile_query(child, max_depth, depth + 1) for child in children]
+        else:
+            summary["children_omitted"] = len(children)
+    return summary
+
+
+def summarize_profile(result: Dict[str, Any], max_depth: int) -> List[Dict[str, Any]]:
+    """Condense the profile section of a search response into a per-shard timing breakdown"""
+    shards = []
+    for shard in result.get("profile", {}).get("shards", []):
+        queries = []
+        rewrite_ms = 0.0
+        collector_ms = 0.0
+        for search in shard.get("searches", []):
+            queries.extend(summarize_profile_query(q, max_depth) for q in search.get("query", []))
+            rewrite_ms += search.get("rewrite_time", 0) / 1_000_000
+            collector_ms += sum(c.get("time_in_nanos", 0) for c in search.get("collector", [])) / 1_000_000
+        aggregations = [
+            {"type": agg.get("type"), "description": agg.get("description"), "time_ms": round(agg.get("time_in_nanos", 0) / 1_000_000, 3)}
+            for agg in shard.get("aggregations", [])
+        ]
+        shard_summary = {
+            "shard": shard.get("id"),
+            "query_ms": round(sum(q["time_ms"] for q in queries), 3),
+            "rewrite_ms": round(rewrite_ms, 3),
+            "collector_ms": round(collector_ms, 3),
+            "queries": queries
+        }
+        if aggregations:
+            shard_summary["aggregations"] = aggregations
+        shards.append(shard_summary)
+    return shards
+
+
+@mcp.tool()
+def opensearch_profile_search(index_name: str = None, query_dsl: Any = None, template_name: str = None, placeholders_json: Union[str, Dict[str, Any]] = None, max_depth: int = 3) -> Dict[str, Any]:
+    """Runs a search with profiling enabled and returns a condensed per-shard, per-clause timing breakdown.
+Provide either `index_name` + `query_dsl`, or `template_name` + `placeholders_json` to profile a template as executeTemplate would run it.
+• `max_depth` - how many levels of the query tree to keep per shard (deeper clauses are counted, not listed)
+
+Each shard lists query clauses (e.g. the lexical and k-NN legs of a hybrid query) with their time and dominant phases,
+plus rewrite and collector time. `coordinator_ms` is `took` minus the slowest shard's query, rewrite and collector
+time, which covers fetch, network and search-pipeline work such as score normalization.
+"""
+    render_ms = 0.0
+    if template_name:
+        placeholders, error = parse_placeholders(placeholders_json, "opensearch_profile_search with template_name")
+        if error:
+            return error
+        rendered = render_template(template_name, placeholders)
+        if "error" in rendered:
+            return rendered
+        index_name = rendered["index_name"]
+        query_dsl = rendered["query"]
+        render_ms = rendered["render_ms"]
+    elif not index_name or query_dsl is None:
+        return {"error": "Either index_name and query_dsl, or template_name and placeholders_json are required"}
+    
+    if isinstance(query_dsl, str):
+        try:
+            query_dsl = json.loads(query_dsl)
+        except json.JSONDecodeError as e:
+            return {"error": f"Invalid JSON in query_dsl: {str(e)}"}
+    if not isinstance(query_dsl, dict):
+        return {"error": f"query_dsl must be a JSON object, got {type(query_dsl)}"}
+    
+    profiled_query = dict(query_dsl, profile=True)
+    response, result = run_search(index_name, profiled_query, "opensearch_profile_search", template_name, render_ms)
+    
+    if response.returncode != 0:
+        return {"error": f"Request failed: {response.stderr}", "returncode": response.returncode}
+    if result is None:
+        return {"error": "Failed to parse JSON response", "raw_response": response.stdout}
+    if "error" in result:
+        return {"error": result["error"], "query": query_dsl}
+    
+    shards = summarize_profile(result, max_depth)
+    took_ms = result.get("took")
+    slowest_shard_ms = max((shard["query_ms"] + shard["rewrite_ms"] + shard["collector_ms"] for shard in shards), default=0.0)
+    total = result.get("hits", {}).get("total")
+    return {
+        "index_name": index_name,
+        "template_name": template_name,
+        "took_ms": took_ms,
+        "coordinator_ms": round(took_ms - slowest_shard_ms, 3) if took_ms is not None else None,
+        "hits_total": total.get("value") if isinstance(total, dict) else total,
+        "shards": shards
+    }
+
+
+@mcp.tool()
+def opensearch_slow_queries(limit: int = 10, clear: bool = False) -> Dict[str, Any]:
+    """Returns the slowest queries recorded by this server, slowest first.
+Every search run through this server is timed end to end. Up to SLOW_QUERY_LOG_SIZE of the slowest are kept,
+with their rendered DSL and phase timings (template rendering, request round trip, OpenSearch `took`, JSON parsing).
+• `limit` - maximum number of entries to return
+• `clear` - empty the log after reading it
+"""
+    with SLOW_QUERY_LOCK:
+        entries = [entry for _, _, entry in sorted(SLOW_QUERIES, key=lambda item: item[0], reverse=True)]
+        if clear:
+            SLOW_QUERIES.clear()
+    return {"capacity": SLOW_QUERY_LOG_SIZE, "recorded": len(entries), "queries": entries[:max(limit, 0)]}
+
+
+def flatten_mapping_properties(properties: Dict[str, Any], prefix: str = "") -> Dict[str, str]:
+    """Flatten mapping properties into {dotted.field.path: type}, including multi-fields such as `name.keyword`.
+    Nested objects keep their own entry with type `nested` so fields under them can be aggregated in a nested context,
+    and plain objects are recorded as `object`."""
+    field_types = {}
+    for name, spec in properties.items():
+        path = f"{prefix}{name}"
+        if "properties" in spec:
+            field_types.update(flatten_mapping_properties(spec["properties"], f"{path}."))
+        if "type" in spec:
+            field_types[path] = spec["type"]
+        elif "properties" in spec:
+            field_types[path] = "object"
+        for sub_name, sub_spec in spec.get("fields", {}).items():
+            if "type" in sub_spec:
+                field_types[f"{path}.{sub_name}"] = sub_spec["type"]
+    return field_types
+
+
+def cache_field_types(index_name: str, index_body: Dict[str, Any]) -> Dict[str, str]:
+    """Cache field types from a GET /{index} or /{index}/_mapping response. Indices behind an alias or pattern are merged."""
+    field_types = {}
+    for index_info in index_body.values():
+        if isinstance(index_info, dict):
+            properties = index_info.get("mappings", {}).get("properties", {})
+            field_types.update(flatten_mapping_properties(properties))
+    MAPPING_CACHE[index_name] = (time.monotonic(), field_types)
+    return field_types
+
+
+def get_field_types(index_name: str) -> Tuple[Optional[Dict[str, str]], Optional[Dict[str, Any]]]:
+    """Return field types for an index from the mapping cache, fetching the mapping if stale. Returns (field_types, error)."""
+    cached = MAPPING_CACHE.get(index_name)
+    if cached and time.monotonic() - cached[0] < MAPPING_CACHE_TTL_SECONDS:
+        return cached[1], None
+    
+    curl_command = f"curl -X GET '{OPENSEARCH_URL}/{index_name}/_mapping' -u admin:{OPENSEARCH_PASSWORD} --insecure"
+    response = subprocess.run(curl_command, shell=True, capture_output=True, text=True)
+    if response.returncode != 0:
+        return None, {"error": f"Mapping request failed: {response.stderr}", "returncode": response.returncode}
+    try:
+        result = json.loads(response.stdout)
+    except json.JSONDecodeError:
+        return None, {"error": "Failed to parse mapping response", "raw_response": response.stdout}
+    if "error" in result:
+        return None, {"error": result["error"]}
+    return cache_field_types(index_name, result), None
+
+
+def build_facet_aggregation(facet: Union[str, Dict[str, Any]], field_types: Dict[str, str], size: int) -> Dict[str, Any]:
+    """Resolve a facet spec against the mapping and build its aggregation.
+    Returns the facet name, aggregatable field, facet type and aggregation body, or error details."""
+    if isinstance(facet, str):
+        facet = {"field": facet}
+    name = facet.get("field")
+    if not name:
+        return {"error": f"Facet is missing a field: {facet}"}
+    field_type = field_types.get(name)
+    if field_type is None:
+        return {"error": f"Field '{name}' not found in mapping"}
+    if field_type in ("nested", "object"):
+        return {"error": f"Field '{name}' has type {field_type} and cannot be faceted, facet one of its sub-fields instead"}
+    
+    # Fields under a nested object are only visible to aggregations run in that nested context
+    nested_path = None
+    parts = name.split(".")
+    for i in range(len(parts) - 1, 0, -1):
+        if field_types.get(".".join(parts[:i])) == "nested":
+            nested_path = ".".join(parts[:i])
+            break
+    
+    # Text fields can't be aggregated, use their keyword sub-field instead
+    field = name
+    if field_type == "text":
+        keyword_fields = [f for f, t in field_types.items() if f.startswith(f"{name}.") and t == "keyword" and f.count(".") == name.count(".") + 1]
+        if not keyword_fields:
+            return {"error": f"Field '{name}' is text without a keyword sub-field and cannot be faceted"}
+        field = keyword_fields[0]
+        field_type = "keyword"
+    
+    is_date = field_type in ("date", "date_nanos")
+    facet_type = facet.get("type") or ("range" if "ranges" in facet else "histogram" if "interval" in facet or is_date else "terms")
+    if not facet.get("type") and facet_type == "terms" and field_type in CONTINUOUS_TYPES:
+        return {"error": f"Field '{name}' is {field_type}; give 'interval' for a histogram or 'ranges' for a range facet"}
+    
+    if facet_type == "terms":
+        aggregation = {"terms": {"field": field, "size": facet.get("size", size)}}
+    elif facet_type == "range":
+        if not facet.get("ranges"):
+            return {"error": f"Range facet on '{name}' requires 'ranges', e.g. [{{\"to\": 50}}, {{\"from\": 50}}]"}
+        aggregation = {"date_range" if is_date else "range": {"field": field, "ranges": facet["ranges"]}}
+    elif facet_type == "histogram":
+        if is_date:
+            interval = facet.get("interval", "month")
+            if interval in CALENDAR_INTERVALS:
+                interval_key = "calendar_interval"
+            elif isinstance(interval, str) and FIXED_INTERVAL_PATTERN.match(interval):
+                interval_key = "fixed_interval"
+            else:
+                return {"error": f"Invalid date interval '{interval}' on '{name}'. Use a single calendar unit "
+                                 f"({', '.join(sorted(CALENDAR_INTERVALS))}) or a multiple of ms/s/m/h/d such as 7d or 12h"}
+            aggregation = {"date_histogram": {"field": field, interval_key: interval, "min_doc_count": 1}}
+        elif "interval" not in facet:
+            return {"error": f"Histogram facet on '{name}' requires 'interval'"}
+        else:
+            aggregation = {"histogram": {"field": field, "interval": facet["interval"], "min_doc_count": 1}}
+    else:
+        return {"error": f"Invalid facet type: {facet_type}. Valid types are: terms, range, histogram"}
+    
+    if nested_path:
+        # Count parent documents per bucket rather than nested objects
+        aggregation["aggs"] = {"documents": {"reverse_nested": {}}}
+        aggregation = {"nested": {"path": nested_path}, "aggs": {"facet": aggregation}}
+    
+    return {"name": name, "field": field, "type": facet_type, "nested_path": nested_path, "aggregation": aggregation}
+
+
+def facet_query(query_dsl: Dict[str, Any]) -> Dict[str, Any]:
+    """Extract the query clause from a query clause or search body (match_all if the body has no query).
+    Hybrid queries are turned into a bool/should over their sub-queries, since hybrid scoring needs a
+    normalization pipeline and plays no part in counting."""
+    if "query" in query_dsl:
+        query = query_dsl["query"]
+    elif not query_dsl or SEARCH_BODY_KEYS.intersection(query_dsl):
+        return {"match_all": {}}
+    else:
+        query = query_dsl
+    if "hybrid" in query:
+        return {"bool": {"should": query["hybrid"].get("queries", []), "minimum_should_match": 1}}
+    return query
+
+
+@mcp.tool()
+def opensearch_facets(index_name: str = None, fields: List[Union[str, Dict[str, Any]]] = None, query_dsl: Any = None, template_name: str = None, placeholders_json: Union[str, Dict[str, Any]] = None, size: int = 10) -> Dict[str, Any]:
+    """Returns facet counts (bucket tables) for fields of an index instead of raw hits. Use this for faceted search and
+    "how many / which values" questions rather than pulling hits through opensearch_search_index.
+Inputs:
+• `index_name` + optional `query_dsl` (query clause or search body; matches all documents if omitted), or
+• `template_name` + `placeholders_json` to facet over the documents a template matches
+• `fields` - field names, or objects {"field", "type", "size", "interval", "ranges"}
+• `size` - default number of buckets per terms facet
+
+Facet type defaults from the mapping: keyword/integer/boolean fields -> terms, text fields -> terms on their
+keyword sub-field, date fields -> monthly histogram. float/double fields need `interval` for a histogram or `ranges`
+(e.g. [{"to": 50}, {"from": 50, "to": 100}]) for a range facet. Date intervals are a single calendar unit
+("1w", "month", "1M", ...) or a multiple of ms/s/m/h/d ("7d", "12h"). Fields under nested objects are aggregated
+in their nested context and count parent documents; nested and object fields themselves cannot be faceted.
+Facets are keyed "field:type"; each returns rows of [key, count], and `other_count` is the number of documents
+(nested objects, for nested fields) outside the listed terms.
+"""
+    if template_name:
+        placeholders, error = parse_placeholders(placeholders_json, "opensearch_facets with template_name")
+        if error:
+            return error
+        rendered = render_template(template_name, placeholders)
+        if "error" in rendered:
+            return rendered
+        index_name = rendered["index_name"]
+        query_dsl = rendered["query"]
+    elif not index_name:
+        return {"error": "Either index_name or template_name and placeholders_json are required"}
+    
+    if isinstance(query_dsl, str):
+        try:
+            query_dsl = json.loads(query_dsl)
+        except json.JSONDecodeError as e:
+            return {"error": f"Invalid JSON in query_dsl: {str(e)}"}
+    if query_dsl is not None and not isinstance(query_dsl, dict):
+        return {"error": f"query_dsl must be a JSON object, got {type(query_dsl)}"}
+    if not fields:
+        return {"error": "At least one field is required"}
+    
+    field_types, error = get_field_types(index_name)
+    if error:
+        return error
+    
+    facets = []
+    for facet in fields:
+        built = build_facet_aggregation(facet, field_types, size)
+        if "error" in built:
+            return built
+        built["key"] = f"{built['name']}:{built['type']}"
+        if any(existing["key"] == built["key"] for existing in facets):
+            return {"error": f"Duplicate facet '{built['key']}'"}
+        facets.append(built)
+    
+    search_body = {
+        "size": 0,
+        "track_total_hits": True,
+        "query": facet_query(query_dsl) if query_dsl else {"match_all": {}},
+        "aggs": {f"facet_{i}": facet["aggregation"] for i, facet in enumerate(facets)}
+    }
+    response, result = run_search(index_name, search_body, "opensearch_facets", template_name)
+    
+    if response.returncode != 0:
+        return {"error": f"Request failed: {response.stderr}", "returncode": response.returncode}
+    if result is None:
+        return {"error": "Failed to parse JSON response", "raw_response": response.stdout}
+    if "error" in result:
+        return {"error": result["error"], "query": search_body}
+    
+    facet_tables = {}
+    aggregations = result.get("aggregations", {})
+    for i, facet in enumerate(facets):
+        aggregation = aggregations.get(f"facet_{i}", {})
+        if facet["nested_path"]:
+            aggregation = aggregation.get("facet", {})
+        table = {
+            "type": facet["type"],
+            "field": facet["field"],
+            "rows": [
+                [bucket.get("key_as_string", bucket.get("key")), bucket.get("documents", bucket).get("doc_count", 0)]
+                for bucket in aggregation.get("buckets", [])
+            ]
+        }
+        if facet["nested_path"]:
+            table["nested_path"] = facet["nested_path"]
+        if aggregation.get("sum_other_doc_count"):
+            table["other_count"] = aggregation["sum_other_doc_count"]
+        facet_tables[facet["key"]] = table
+    
+    total = result.get("hits", {}).get("total")
+    return {
+        "index_name": index_name,
+        "took_ms": result.get("took"),
+        "hits_total": total.get("value") if isinstance(total, dict) else total,
+        "facets": facet_tables
+    }
+
+
 if __name__ == "__main__":
     # Start the server using Streamable HTTP transport
     mcp.run(transport="streamable-http")